@@ -17,6 +17,16 @@
   value: {{ $.Values.numWorkers | quote }}
 - name: X_CSI_DONT_USE_TRASH_API
   value: {{ $.Values.dontUseTrashApi | quote }}
+- name: X_CSI_SERVER_PROCESSES
+  value: {{ $.Values.serverProcesses | quote }}
+{{ if $.Values.maxConcurrentRpcs -}}
+- name: X_CSI_MAX_CONCURRENT_RPCS
+  value: {{ $.Values.maxConcurrentRpcs | quote }}
+{{- end }}
+{{ if $.Values.defaultMountOptions -}}
+- name: X_CSI_DEFAULT_MOUNT_OPTIONS
+  value: {{ $.Values.defaultMountOptions | quote }}
+{{- end }}
 {{ if $.Values.truncateVolumeName -}}
 - name: X_CSI_TRUNCATE_VOLUME_NAME
   value: {{ $.Values.truncateVolumeName | quote }}
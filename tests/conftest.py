@@ -35,6 +35,7 @@ for cls in (Controller, Node):
 
 # Load configuration
 import vast_csi.server
+import vast_csi.vms_session
 
 vast_csi.server.CONF = Config()
 
@@ -113,6 +114,13 @@ class FakeSession:
 # ----------------------------------------------------------------------------------------------------------------------
 
 
+@pytest.fixture(autouse=True)
+def reset_vms_session():
+    """Drop the shared VMS session after each test, so that patches and caches don't leak between tests"""
+    yield
+    vast_csi.vms_session._vms_session = None
+
+
 @pytest.fixture
 def volume_capabilities():
     """Factory for building VolumeCapabilities"""
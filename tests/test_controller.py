@@ -1,6 +1,11 @@
 import re
 import pytest
-from vast_csi.server import Controller, Abort, MissingParameter
+from unittest.mock import patch, MagicMock
+from requests import Response
+from plumbum import local
+from easypy.bunch import Bunch
+from vast_csi.server import Controller, Abort, MissingParameter, DEFAULT_PAGE_SIZE
+from vast_csi.exceptions import ApiError, InvalidPageLink
 
 import grpc
 import vast_csi.csi_types as types
@@ -67,6 +72,7 @@ class TestControllerSuite:
         assert session.get_quota.call_count == 1
         assert session.ensure_view.call_args.args == ()
         assert session.get_quota.call_args.args == ("test_volume",)
+        assert session.get_quota.call_args.kwargs == dict(path="/foo/bar/test_volume")
 
     @pytest.mark.parametrize("raw_mount_options", [
         "[vers=4 ,  nolock,   proto=tcp,   nconnect=4]",
@@ -79,3 +85,144 @@ class TestControllerSuite:
     def test_parse_mount_options(self, raw_mount_options):
         mount_options = ",".join(re.sub(r"[\[\]]", "", raw_mount_options).replace(",", " ").split())
         assert mount_options == "vers=4,nolock,proto=tcp,nconnect=4"
+
+    @pytest.mark.parametrize("in_memory", [True, False])
+    def test_list_snapshots_mock(self, tmp_path, in_memory):
+        """Test mock snapshot listing is paginated in stable order and filtered by volume or snapshot id"""
+        # Preparation
+        cont = Controller()
+        conf = Bunch(mock_vast=True, fake_snapshots_in_memory=in_memory, fake_snapshot_store=local.path(tmp_path))
+
+        # Execution
+        with patch("vast_csi.server.CONF", conf), patch.object(Controller, "_fake_snapshots", {}):
+            for i in range(5):
+                cont._save_fake_snapshot(types.Snapshot(snapshot_id=f"snap-{i}", source_volume_id=f"vol-{i % 2}"))
+            ordered = [snap.snapshot_id for _, snap in cont._iter_fake_snapshots()]
+            first = cont.ListSnapshots(max_entries=2)
+            second = cont.ListSnapshots(max_entries=2, starting_token=first.next_token)
+            last = cont.ListSnapshots(max_entries=2, starting_token=second.next_token)
+            filtered = cont.ListSnapshots(source_volume_id="vol-1")
+            by_id = cont.ListSnapshots(snapshot_id="snap-3")
+            by_id_other_volume = cont.ListSnapshots(snapshot_id="snap-3", source_volume_id="vol-0")
+            cont.DeleteSnapshot(snapshot_id="snap-3")
+            deleted = cont.ListSnapshots(snapshot_id="snap-3")
+            unknown = cont.ListSnapshots(snapshot_id="unknown")
+
+        # Assertion
+        assert sorted(ordered) == [f"snap-{i}" for i in range(5)]
+        pages = [[e.snapshot.snapshot_id for e in page.entries] for page in (first, second, last)]
+        assert pages == [ordered[:2], ordered[2:4], ordered[4:]]
+        assert first.next_token and second.next_token and not last.next_token
+        assert sorted(e.snapshot.snapshot_id for e in filtered.entries) == ["snap-1", "snap-3"]
+        assert not filtered.next_token
+        assert [e.snapshot.snapshot_id for e in by_id.entries] == ["snap-3"]
+        assert not by_id_other_volume.entries
+        assert not deleted.entries
+        assert not unknown.entries
+
+    @pytest.mark.parametrize("snapshot_path, handled", [("/k8s/test_volume", True), ("/k8s/other_volume", False)])
+    def test_create_snapshot_name_not_unique(self, fake_session, snapshot_path, handled):
+        """Test 'name must be unique' error from VMS resolves to the existing snapshot only when it has the same path"""
+        # Preparation
+        cont = Controller()
+        response = Response()
+        response.status_code = 400
+        response.headers["Content-Type"] = "application/json"
+        response._content = b'{"name": ["This field must be unique."]}'
+        existing = Bunch(id=2, path=snapshot_path, created="2023-01-01T00:00:00Z")
+        parameters = {
+            "csi.storage.k8s.io/volumesnapshot/name": "snap",
+            "csi.storage.k8s.io/volumesnapshot/namespace": "default",
+        }
+
+        # Execution
+        with fake_session() as session:
+            session.get_quota = MagicMock(return_value=Bunch(id=1, path="/k8s/test_volume", tenant_id=1))
+            session.ensure_snapshot = MagicMock(side_effect=ApiError(response=response))
+            session.get_snapshot = MagicMock(return_value=existing)
+            if handled:
+                resp = cont.CreateSnapshot(source_volume_id="test_volume", name="snap-id", parameters=parameters)
+            else:
+                with pytest.raises(Abort) as ex_context:
+                    cont.CreateSnapshot(source_volume_id="test_volume", name="snap-id", parameters=parameters)
+
+        # Assertion
+        if handled:
+            assert resp.snapshot.snapshot_id == "2"
+        else:
+            assert ex_context.value.code == grpc.StatusCode.ALREADY_EXISTS
+
+    @pytest.mark.parametrize("starting_token, max_entries", [(None, 0), (None, 10), ("token", 0)])
+    def test_list_volumes_paging(self, fake_session, starting_token, max_entries):
+        """Test first page of volumes is bounded and following pages are fetched by token"""
+        # Preparation
+        cont = Controller()
+        next_page = "https://vast/api/quotas/?page=2&page_size=10"
+        page = Bunch.from_dict(dict(
+            count=2, next=next_page, previous=None, results=[dict(id=1, path="/k8s/test_volume", hard_limit=1000)]
+        ))
+
+        # Execution
+        with fake_session() as session:
+            session.list_quotas = MagicMock(return_value=page)
+            session.get_by_token = MagicMock(return_value=page)
+            resp = cont.ListVolumes(starting_token=starting_token, max_entries=max_entries)
+
+        # Assertion
+        assert resp.next_token == next_page
+        assert [e.volume.volume_id for e in resp.entries] == ["test_volume"]
+        if starting_token:
+            session.get_by_token.assert_called_once_with(token=starting_token)
+            session.list_quotas.assert_not_called()
+        else:
+            session.list_quotas.assert_called_once_with(max_entries=max_entries or DEFAULT_PAGE_SIZE)
+            session.get_by_token.assert_not_called()
+
+    @pytest.mark.parametrize("path, volume_id", [
+        ("/k8s/test_volume", "test_volume"),
+        ("/k8s/test_volume/", "test_volume"),
+        ("/k8s/nested/test_volume", "nested/test_volume"),
+        ("/k8s-other/test_volume", None),
+        ("/other/test_volume", None),
+        ("/k8s/../test_volume", None),
+    ])
+    def test_to_volume_id(self, path, volume_id):
+        """Test volume id is taken relative to the root export"""
+        with patch("vast_csi.server.CONF", Bunch(nfs_export_prefix="/k8s/")):
+            assert Controller._to_volume_id(path) == volume_id
+
+    def test_delete_volume_keeps_quota_when_view_removal_fails(self, fake_session):
+        """Test quota outlives a failed view removal, so a retried DeleteVolume can still find the volume"""
+        # Preparation
+        cont = Controller()
+        quota = Bunch(id=1, path="/k8s/test_volume", tenant_id=1)
+
+        # Execution
+        with fake_session() as session, patch.object(Controller, "_delete_data_from_storage"):
+            session.get_quota = MagicMock(return_value=quota)
+            session.delete_view_by_path = MagicMock(side_effect=Exception("view removal failed"))
+            session.delete_quota = MagicMock()
+            with pytest.raises(Exception, match="view removal failed"):
+                cont.DeleteVolume(volume_id="test_volume")
+
+        # Assertion
+        session.delete_view_by_path.assert_called_once_with(quota.path)
+        session.delete_quota.assert_not_called()
+
+    @pytest.mark.parametrize("method", ["ListVolumes", "ListSnapshots"])
+    def test_list_foreign_starting_token(self, fake_session, method):
+        """Test a starting token that isn't a VMS page link is rejected as invalid"""
+        # Preparation
+        cont = Controller()
+
+        # Execution
+        with fake_session() as session:
+            session.get_by_token = MagicMock(
+                side_effect=InvalidPageLink(link="http://attacker/", base_url="https://vast/api")
+            )
+            with pytest.raises(Abort) as ex_context:
+                getattr(cont, method)(starting_token="http://attacker/")
+
+        # Assertion
+        assert ex_context.value.code == grpc.StatusCode.ABORTED
+        assert ex_context.value.message == "Invalid starting_token"
@@ -0,0 +1,168 @@
+import os
+import pytest
+from errno import ESTALE, EINVAL, EBUSY
+from unittest.mock import patch, MagicMock
+
+from vast_csi.server import Node, umount
+from vast_csi.utils import json_dumps, json_loads
+import vast_csi.csi_types as types
+
+
+class TestNodeSuite:
+
+    def test_unpublish_stale_mount(self, tmp_path):
+        """Test a target that can't be stat-ed (stale NFS handle) is still unmounted and removed"""
+        # Preparation
+        node = Node()
+        target_path = tmp_path / "target"
+        target_path.mkdir()
+        stale = {"target": True}
+        real_stat, real_lstat = os.stat, os.lstat
+
+        def stale_aware(real):
+            def stat(path, *args, **kwargs):
+                if stale["target"] and str(path) == str(target_path):
+                    raise OSError(ESTALE, os.strerror(ESTALE), str(path))
+                return real(path, *args, **kwargs)
+            return stat
+
+        def umount(path):
+            stale["target"] = False
+            return True
+
+        # Execution
+        with (
+                patch("os.stat", side_effect=stale_aware(real_stat)),
+                patch("os.lstat", side_effect=stale_aware(real_lstat)),
+                patch("vast_csi.server.get_mount", side_effect=lambda path, **kwargs: stale["target"] or None),
+                patch("vast_csi.server.umount", side_effect=umount) as umount_mock,
+        ):
+            node.NodeUnpublishVolume(target_path=str(target_path))
+
+        # Assertion
+        umount_mock.assert_called_once_with(target_path)
+        assert not target_path.exists()
+
+    @pytest.mark.parametrize("ret, errno, expected", [(0, 0, True), (-1, EINVAL, False), (-1, EBUSY, OSError)])
+    def test_umount_errno(self, ret, errno, expected):
+        """Test umount2 results map to unmounted / not a mount point / failure"""
+        libc = MagicMock()
+        libc.umount2.return_value = ret
+        with (
+                patch("vast_csi.server._libc", return_value=libc),
+                patch("ctypes.get_errno", return_value=errno),
+                patch("vast_csi.server.invalidate_mounts") as invalidate_mounts,
+        ):
+            if expected is OSError:
+                with pytest.raises(OSError) as exc:
+                    umount("/mnt/target")
+                assert exc.value.errno == errno
+                assert exc.value.filename == "/mnt/target"
+            else:
+                assert umount("/mnt/target") is expected
+
+        libc.umount2.assert_called_once_with(b"/mnt/target", 0)
+        invalidate_mounts.assert_called_once_with()
+
+    def test_publish_writes_meta(self, tmp_path):
+        """Test publish creates the target with its .vast-csi-meta and mounts the export on it"""
+        # Preparation
+        node = Node()
+        target_path = tmp_path / "pods" / "target"
+        capability = types.VolumeCapability(
+            mount=types.MountVolume(), access_mode=types.AccessMode(mode=types.AccessModeType.SINGLE_NODE_WRITER)
+        )
+
+        # Execution
+        with patch("vast_csi.server.mount") as mount, patch("vast_csi.server.get_mount", return_value=None):
+            node.NodePublishVolume(
+                volume_id="test_volume",
+                target_path=str(target_path),
+                volume_capability=capability,
+                publish_context=dict(nfs_server_ip="15.0.0.1", export_path="/k8s/test_volume"),
+            )
+
+        # Assertion
+        assert json_loads((target_path / ".vast-csi-meta").read_bytes()) == \
+               dict(volume_id="test_volume", is_ephemeral=False)
+        assert mount.call_args.args == ("15.0.0.1:/k8s/test_volume", target_path)
+
+    @pytest.mark.parametrize("meta", [None, dict(volume_id="test_volume", is_ephemeral=False)])
+    def test_unpublish_removes_target(self, tmp_path, meta):
+        """Test unpublish of an unmounted target removes it along with its .vast-csi-meta, if any"""
+        # Preparation
+        node = Node()
+        target_path = tmp_path / "target"
+        target_path.mkdir()
+        if meta:
+            (target_path / ".vast-csi-meta").write_bytes(json_dumps(meta))
+
+        # Execution
+        with (
+                patch("vast_csi.server.get_mount", return_value=None),
+                patch("vast_csi.server.umount") as umount_mock,
+                patch("vast_csi.server.Controller") as controller,
+        ):
+            node.NodeUnpublishVolume(target_path=str(target_path))
+
+        # Assertion
+        assert not target_path.exists()
+        umount_mock.assert_not_called()
+        controller.assert_not_called()
+
+    def test_unpublish_ephemeral(self, tmp_path):
+        """Test unpublish of an ephemeral volume unmounts it, deletes the volume and removes the target"""
+        # Preparation
+        node = Node()
+        target_path = tmp_path / "target"
+        target_path.mkdir()
+        (target_path / ".vast-csi-meta").write_bytes(json_dumps(dict(volume_id="eph_volume", is_ephemeral=True)))
+        mounted = {"target": True}
+
+        def umount(path):
+            mounted["target"] = False
+            return True
+
+        # Execution
+        with (
+                patch("vast_csi.server.maybe_mounted", return_value=True),
+                patch("vast_csi.server.get_mount", side_effect=lambda path, **kwargs: mounted["target"] or None),
+                patch("vast_csi.server.umount", side_effect=umount) as umount_mock,
+                patch("vast_csi.server.Controller") as controller,
+        ):
+            delete_volume = controller.return_value.DeleteVolume.__wrapped__ = MagicMock()
+            node.NodeUnpublishVolume(target_path=str(target_path))
+
+        # Assertion
+        umount_mock.assert_called_once_with(target_path)
+        delete_volume.assert_called_once_with(controller.return_value, "eph_volume")
+        assert not target_path.exists()
+
+    def test_publish_already_mounted(self, tmp_path):
+        """Test publish on a target that may be mounted checks the fresh mount table and doesn't mount again"""
+        # Preparation
+        node = Node()
+        target_path = tmp_path / "target"
+        target_path.mkdir()
+        capability = types.VolumeCapability(
+            mount=types.MountVolume(), access_mode=types.AccessMode(mode=types.AccessModeType.SINGLE_NODE_WRITER)
+        )
+        found_mount = MagicMock(device="15.0.0.1:/k8s/test_volume", opts="rw,vers=3")
+
+        # Execution
+        with (
+                patch("vast_csi.server.maybe_mounted", return_value=True),
+                patch("vast_csi.server.get_mount", return_value=found_mount) as get_mount,
+                patch("vast_csi.server.mount") as mount,
+        ):
+            node.NodePublishVolume(
+                volume_id="test_volume",
+                target_path=str(target_path),
+                volume_capability=capability,
+                publish_context=dict(nfs_server_ip="15.0.0.1", export_path="/k8s/test_volume"),
+            )
+
+        # Assertion
+        get_mount.assert_called_once_with(target_path, fresh=True)
+        mount.assert_not_called()
+        assert not (target_path / ".vast-csi-meta").exists()
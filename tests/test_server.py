@@ -0,0 +1,40 @@
+import signal
+import pytest
+from unittest.mock import patch, MagicMock, call
+
+from vast_csi.server import _serve_forked
+
+
+class TestServeSuite:
+
+    def test_serve_forked_stops_all_when_worker_exits(self):
+        """Test the parent stops the remaining workers and exits with an error once any worker exits"""
+        with (
+                patch("os.fork", side_effect=[101, 102, 103]),
+                patch("os.wait", return_value=(102, 256)) as wait,
+                patch("os.kill") as kill,
+                patch("os.waitpid") as waitpid,
+                patch("vast_csi.server._start_server") as start_server,
+        ):
+            with pytest.raises(SystemExit) as exc:
+                _serve_forked(3)
+
+        assert exc.value.code == 1
+        wait.assert_called_once_with()
+        assert kill.call_args_list == [call(101, signal.SIGTERM), call(103, signal.SIGTERM)]
+        assert waitpid.call_args_list == [call(101, 0), call(103, 0)]
+        start_server.assert_not_called()
+
+    @pytest.mark.parametrize("failure, exit_code", [(None, 0), (RuntimeError("bind failed"), 1)])
+    def test_serve_forked_worker(self, failure, exit_code):
+        """Test a forked worker serves and exits with an error code only if serving failed"""
+        with (
+                patch("os.fork", return_value=0),
+                patch("os._exit", side_effect=SystemExit) as _exit,
+                patch("vast_csi.server._start_server", side_effect=failure, return_value=MagicMock()) as start_server,
+        ):
+            with pytest.raises(SystemExit):
+                _serve_forked(2)
+
+        start_server.assert_called_once_with(options=[("grpc.so_reuseport", 1)])
+        _exit.assert_called_once_with(exit_code)
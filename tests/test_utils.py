@@ -1,5 +1,11 @@
+import os
 import pytest
-from vast_csi.utils import is_ver_nfs4_present, generate_ip_range
+from unittest.mock import patch, MagicMock
+from plumbum import local
+from vast_csi.utils import (
+    is_ver_nfs4_present, generate_ip_range, LazyPformat, scandir_by_inode, json_dumps, json_loads, merge_mount_options,
+    get_mount, invalidate_mounts, maybe_mounted,
+)
 
 
 @pytest.mark.parametrize(
@@ -40,3 +46,86 @@ def test_parse_nfs4_mount_option(options, exepected):
 def test_generate_ip_range(ip_ranges, expected):
     ips = generate_ip_range(ip_ranges)
     assert ips == expected
+
+
+def test_lazy_pformat():
+    lazy = LazyPformat(dict(a=1, b="x"))
+    assert str(lazy) == "    {'a': 1, 'b': 'x'}"
+    assert "%s" % LazyPformat([]) == "    []"
+
+
+def test_scandir_by_inode(tmp_path):
+    for name in ("a", "b", "c"):
+        (tmp_path / name).write_text(name)
+    (tmp_path / "subdir").mkdir()
+
+    entries = scandir_by_inode(tmp_path, os.DirEntry.is_file)
+    inodes = [inode for inode, _ in entries]
+    assert inodes == sorted(inodes)
+    assert sorted(d.name for _, d in entries) == ["a", "b", "c"]
+    assert [d.name for _, d in scandir_by_inode(tmp_path, os.DirEntry.is_file, after=inodes[0])] == \
+           [d.name for _, d in entries[1:]]
+    assert [d.name for _, d in scandir_by_inode(tmp_path, os.DirEntry.is_dir)] == ["subdir"]
+
+
+def test_json_dumps(tmp_path):
+    data = json_loads(json_dumps(dict(path=tmp_path, hard_limit=10)))
+    assert data == dict(path=str(tmp_path), hard_limit=10)
+
+
+@pytest.mark.parametrize(
+    "options, defaults, expected",
+    [
+        (["ro"], ["noatime", "actimeo=30"], ["ro", "noatime", "actimeo=30"]),
+        (["actimeo=5"], ["noatime", "actimeo=30"], ["actimeo=5", "noatime"]),
+        (["noac"], ["ac", "nconnect=4"], ["noac", "nconnect=4"]),
+        (["nfsvers=3"], ["vers=4.1"], ["nfsvers=3"]),
+        ([], [], []),
+    ],
+)
+def test_merge_mount_options(options, defaults, expected):
+    assert merge_mount_options(options, defaults) == expected
+
+
+def test_get_mount_cached_until_invalidated():
+    partitions = [MagicMock(mountpoint="/mnt/a"), MagicMock(mountpoint="/mnt/b")]
+    invalidate_mounts()
+    with patch("psutil.disk_partitions", return_value=partitions) as disk_partitions:
+        assert get_mount(local.path("/mnt/a")) is partitions[0]
+        assert get_mount("/mnt/b") is partitions[1]
+        assert get_mount("/mnt/c") is None
+        assert disk_partitions.call_count == 1
+
+        invalidate_mounts()
+        get_mount("/mnt/a")
+        assert disk_partitions.call_count == 2
+    invalidate_mounts()
+
+
+def test_maybe_mounted(tmp_path):
+    assert maybe_mounted("/")
+    assert not maybe_mounted(tmp_path)
+    assert not maybe_mounted(tmp_path / "missing")
+    with patch("os.lstat", side_effect=OSError(116, "Stale file handle")):
+        assert maybe_mounted(tmp_path)
+
+
+def test_get_mount_fresh_and_concurrent_invalidation():
+    partitions = [MagicMock(mountpoint="/mnt/a")]
+    invalidate_mounts()
+
+    def read_racing_with_mount(all):
+        invalidate_mounts()  # another thread's mount() completes while the table is being read
+        return partitions
+
+    with patch("psutil.disk_partitions", side_effect=read_racing_with_mount) as disk_partitions:
+        get_mount("/mnt/a")
+        get_mount("/mnt/a")
+        assert disk_partitions.call_count == 2  # a table read during an invalidation is never cached
+
+    with patch("psutil.disk_partitions", return_value=partitions) as disk_partitions:
+        get_mount("/mnt/a")
+        get_mount("/mnt/a")
+        get_mount("/mnt/a", fresh=True)
+        assert disk_partitions.call_count == 2
+    invalidate_mounts()
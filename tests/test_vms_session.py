@@ -1,10 +1,14 @@
 import pytest
 from io import BytesIO
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, PropertyMock, MagicMock
 from vast_csi.server import Controller
+from vast_csi.vms_session import VmsSession
 from requests import Response, Request, HTTPError
-from vast_csi.exceptions import OperationNotSupported, ApiError
+from vast_csi.exceptions import OperationNotSupported, ApiError, InvalidPageLink
 from easypy.semver import SemVer
+from easypy.bunch import Bunch
 
 
 class TestVmsSessionSuite:
@@ -125,3 +129,242 @@ class TestVmsSessionSuite:
 
         # Assertion
         assert "Trash Folder Access is disabled" in str(exc.value)
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_get_quota_cached_until_modified(self):
+        """Test repeated quota lookups hit VMS once until the quota is modified"""
+        # Preparation
+        cont = Controller()
+        quota = Bunch(id=1, path="/k8s/test_volume")
+
+        # Execution
+        with (
+                patch("vast_csi.vms_session.VmsSession.quotas", return_value=[quota], create=True) as quotas,
+                patch("vast_csi.vms_session.VmsSession.delete"),
+        ):
+            session = cont.vms_session
+            assert session.get_quota("test_volume") is quota
+            assert session.get_quota("test_volume") is quota
+            calls_before_delete = quotas.call_count
+            session.delete_quota(quota.id)
+            session.get_quota("test_volume")
+
+        # Assertion
+        assert calls_before_delete == 1
+        assert quotas.call_count == 2
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    @patch("vast_csi.vms_session.VmsSession.QUOTA_CACHE_SIZE", 2)
+    def test_get_quota_cache_bounded(self):
+        """Test the quota cache keeps only the most recently used lookups"""
+        # Preparation
+        cont = Controller()
+
+        # Execution
+        with patch("vast_csi.vms_session.VmsSession.quotas", return_value=[Bunch(id=1)]) as quotas:
+            session = cont.vms_session
+            for volume_id in ("vol1", "vol2", "vol1", "vol3"):
+                session.get_quota(volume_id)
+            calls_before = quotas.call_count
+            session.get_quota("vol1")  # still cached, as it was used more recently than vol2
+            session.get_quota("vol2")  # evicted
+
+        # Assertion
+        assert calls_before == 3
+        assert quotas.call_count == 4
+        assert len(session._quota_cache) == 2
+
+    @pytest.mark.parametrize("server_processes, found, expected_calls", [(1, True, 1), (1, False, 2), (2, True, 2)])
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_get_quota_cache_bypassed(self, server_processes, found, expected_calls):
+        """Test missing quotas aren't cached, nor any quota when other server processes may modify them"""
+        # Preparation
+        cont = Controller()
+
+        # Execution
+        with (
+                patch("vast_csi.configuration.Config.server_processes", PropertyMock(return_value=server_processes)),
+                patch("vast_csi.vms_session.VmsSession.quotas", return_value=[Bunch(id=1)] if found else []) as quotas,
+        ):
+            session = cont.vms_session
+            session.get_quota("test_volume")
+            session.get_quota("test_volume")
+
+        # Assertion
+        assert quotas.call_count == expected_calls
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_get_vip_caches_vippool(self):
+        """Test vip pool is requested from VMS once for consecutive get_vip calls"""
+        # Preparation
+        cont = Controller()
+        vippool = dict(tenant_id=1, ip_ranges=[["15.0.0.1", "15.0.0.2"]])
+
+        # Execution
+        with patch("vast_csi.vms_session.VmsSession.vippools", return_value=[vippool], create=True) as vippools:
+            session = cont.vms_session
+            vips = {session.get_vip("vippool-1", tenant_id=1, load_balancing="roundrobin") for _ in range(4)}
+
+        # Assertion
+        assert vippools.call_count == 1
+        assert vips == {"15.0.0.1", "15.0.0.2"}
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_get_quota_by_exact_path(self):
+        """Test quota is filtered by exact path on VMS side when the volume path is known"""
+        # Preparation
+        cont = Controller()
+
+        # Execution
+        with patch("vast_csi.vms_session.VmsSession.quotas", return_value=[], create=True) as quotas:
+            cont.vms_session.get_quota("test_volume", path="/k8s/test_volume/")
+            cont.vms_session.get_quota("test_volume")
+
+        # Assertion
+        assert [c.kwargs for c in quotas.call_args_list] == [
+            dict(path="/k8s/test_volume"), dict(path__contains="test_volume")
+        ]
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_session_pooling_and_retries(self):
+        """Test VMS requests go through a pooled adapter that retries idempotent requests only"""
+        # Preparation
+        cont = Controller()
+
+        # Execution
+        adapter = cont.vms_session.get_adapter(cont.vms_session.base_url)
+
+        # Assertion
+        assert adapter._pool_maxsize >= cont.vms_session.config.worker_threads
+        assert adapter.max_retries.total == 3
+        assert adapter.max_retries.is_retry("GET", 502)
+        assert not adapter.max_retries.is_retry("POST", 502)
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_get_by_token_uses_prefetched_page(self):
+        """Test the page following a listing is fetched ahead and served by `get_by_token`"""
+        # Preparation
+        cont = Controller()
+        pages = {"page2": Bunch(next="page3", results=[2]), "page3": Bunch(next=None, results=[3])}
+
+        # Execution
+        with (
+                patch("vast_csi.vms_session.VmsSession.quotas", return_value=Bunch(next="page2", results=[1])),
+                patch("vast_csi.vms_session.VmsSession.get", side_effect=pages.get) as get,
+        ):
+            session = cont.vms_session
+            first = session.list_quotas(max_entries=1)
+            second = session.get_by_token(first.next)
+            third = session.get_by_token(second.next)
+
+        # Assertion
+        assert [first.results, second.results, third.results] == [[1], [2], [3]]
+        assert [c.args for c in get.call_args_list] == [("page2",), ("page3",)]
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    @patch("vast_csi.vms_session.VmsSession._prefetch_pool", None)
+    def test_get_by_token_refetches_expired_page(self):
+        """Test the prefetch pool is created on first use and stale prefetched pages are fetched again"""
+        # Preparation
+        cont = Controller()
+        session = cont.vms_session
+        assert VmsSession._prefetch_pool is None
+
+        # Execution
+        with (
+                patch("vast_csi.vms_session.VmsSession.quotas", return_value=Bunch(next="page2", results=[1])),
+                patch("vast_csi.vms_session.VmsSession.get", return_value=Bunch(next=None, results=[2])) as get,
+                patch("vast_csi.vms_session.monotonic", side_effect=[0, VmsSession.PREFETCH_TTL + 1]),
+        ):
+            first = session.list_quotas(max_entries=1)
+            second = session.get_by_token(first.next)
+
+        # Assertion
+        assert VmsSession._prefetch_pool is not None
+        assert second.results == [2]
+        assert [c.args for c in get.call_args_list] == [("page2",), ("page2",)]
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_get_vip_round_robin_concurrent(self):
+        """Test round robin spreads vips evenly when get_vip is called from many threads"""
+        # Preparation
+        cont = Controller()
+        vippool = dict(tenant_id=1, ip_ranges=[["15.0.0.1", "15.0.0.3"]])
+
+        # Execution
+        with patch("vast_csi.vms_session.VmsSession.vippools", return_value=[vippool]):
+            session = cont.vms_session
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                vips = list(pool.map(
+                    lambda _: session.get_vip("vippool-rr", load_balancing="roundrobin"), range(30)
+                ))
+
+        # Assertion
+        assert Counter(vips) == {"15.0.0.1": 10, "15.0.0.2": 10, "15.0.0.3": 10}
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token")
+    def test_vms_session_shared(self, refresh_auth_token):
+        """Test all controllers (including those created by Node for ephemeral volumes) share one VMS session"""
+        # Execution
+        sessions = {id(Controller().vms_session) for _ in range(3)}
+
+        # Assertion
+        assert len(sessions) == 1
+        refresh_auth_token.assert_called_once()
+
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_get_by_token_requests_page_link(self):
+        """Test the 'next' link of a VMS page is requested as is rather than appended to the api base url"""
+        # Preparation
+        cont = Controller()
+        response = Response()
+        response.status_code = 200
+        response._content = b'{"next": null, "results": []}'
+        next_page = f"{cont.vms_session.base_url}/quotas/?page=2&page_size=10"
+
+        # Execution
+        with patch("requests.Session.request", return_value=response) as request:
+            page = cont.vms_session.get_by_token(next_page)
+
+        # Assertion
+        assert request.call_args.args[:2] == ("GET", next_page)
+        assert page.results == [] and page.next is None
+
+    @pytest.mark.parametrize("token", ["http://attacker/api/quotas/?page=2", "https://vast.evil.com/api/quotas/"])
+    @patch("vast_csi.configuration.Config.vms_user", PropertyMock("test"))
+    @patch("vast_csi.configuration.Config.vms_password", PropertyMock("test"))
+    @patch("vast_csi.vms_session.VmsSession.refresh_auth_token", MagicMock())
+    def test_get_by_token_rejects_foreign_link(self, token):
+        """Test page links not pointing at the VMS api are refused, so credentials are never sent elsewhere"""
+        # Preparation
+        cont = Controller()
+
+        # Execution
+        with patch("requests.Session.request") as request:
+            with pytest.raises(InvalidPageLink):
+                cont.vms_session.get_by_token(token)
+
+        # Assertion
+        request.assert_not_called()
@@ -11,6 +11,8 @@ from easypy.tokens import (
 )
 from easypy.caching import cached_property
 
+from .utils import parse_load_balancing_strategy
+
 
 class Config(TypedEnv):
     class Path(TypedEnv.Str):
@@ -42,15 +44,20 @@ class Config(TypedEnv):
     load_balancing = TypedEnv.Str("X_CSI_LB_STRATEGY", default="roundrobin")
     truncate_volume_name = TypedEnv.Int("X_CSI_TRUNCATE_VOLUME_NAME", default=None)
     worker_threads = TypedEnv.Int("X_CSI_WORKER_THREADS", default=10)
+    _max_concurrent_rpcs = TypedEnv.Int("X_CSI_MAX_CONCURRENT_RPCS", default=None)
+    server_processes = TypedEnv.Int("X_CSI_SERVER_PROCESSES", default=1)  # only applies to tcp endpoints
     dont_use_trash_api = TypedEnv.Bool("X_CSI_DONT_USE_TRASH_API", default=True)
 
     _mode = TypedEnv.Str("CSI_MODE", default="controller_and_node")
     _endpoint = TypedEnv.Str("CSI_ENDPOINT", default="unix:///var/run/csi.sock")
     _mount_options = TypedEnv.Str("X_CSI_MOUNT_OPTIONS", default="")  # For example: "port=2049,nolock,vers=3"
+    # Merged into node mounts unless overridden by the volume's own options. For example: "noatime,actimeo=30,nconnect=4"
+    _default_mount_options = TypedEnv.Str("X_CSI_DEFAULT_MOUNT_OPTIONS", default="")
     name_fmt = "csi:{namespace}:{name}:{id}"
 
     fake_quota_store = local.path("/tmp/volumes")
     fake_snapshot_store = local.path("/tmp/snapshots")
+    fake_snapshots_in_memory = TypedEnv.Bool("X_CSI_MOCK_SNAPSHOTS_IN_MEMORY", default=True)
 
     @cached_property
     def vms_user(self):
@@ -60,11 +67,30 @@ class Config(TypedEnv):
     def vms_password(self):
         return self.vms_credentials_store['password'].read().strip()
 
+    @cached_property
+    def nfs_export_prefix(self):
+        """`sanity_test_nfs_export` with a trailing slash, for matching paths returned by VMS"""
+        return str(self.sanity_test_nfs_export).rstrip("/") + "/"
+
     @property
     def mount_options(self):
         s = self._mount_options.strip()
         return list({p for p in s.split(',') if p})
 
+    @cached_property
+    def load_balancing_strategy(self):
+        """Parsed `load_balancing`, the fallback for volumes that don't set their own strategy"""
+        return parse_load_balancing_strategy(self.load_balancing)
+
+    @property
+    def max_concurrent_rpcs(self):
+        """RPCs accepted beyond this are rejected with RESOURCE_EXHAUSTED instead of queueing up"""
+        return self._max_concurrent_rpcs or self.worker_threads * 4
+
+    @property
+    def default_mount_options(self):
+        return [p for p in self._default_mount_options.strip().split(',') if p]
+
     unmount_attempts = TypedEnv.Int("X_CSI_UNMOUNT_ATTEMPTS", default=10)
 
     @property
@@ -54,3 +54,7 @@ class SourceNotFound(BuilderFailed):
 
 class VolumeAlreadyExists(BuilderFailed):
     pass
+
+
+class InvalidPageLink(TException):
+    template = "Page link {link!r} does not point to the VMS api at {base_url}"
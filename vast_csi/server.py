@@ -14,23 +14,28 @@
 """The Python implementation of the GRPC helloworld.Greeter server."""
 
 import os
-import re
+import sys
+import signal
+import logging
+import ctypes
+import ctypes.util
+from errno import EINVAL
 from concurrent import futures
-from functools import wraps
-from pprint import pformat
+from functools import wraps, lru_cache
 from datetime import datetime
 import inspect
+from bisect import bisect_right
+from itertools import count, islice
+from pathlib import Path
 from tempfile import mkdtemp
+from typing import ClassVar
 
-import json
-from json import JSONDecodeError
-from plumbum import cmd
 from plumbum import local, ProcessExecutionError
 import grpc
 from requests.exceptions import HTTPError
 
 from easypy.tokens import ROUNDROBIN, RANDOM, CONTROLLER_AND_NODE, CONTROLLER, NODE
-from easypy.misc import kwargs_resilient, at_least
+from easypy.misc import kwargs_resilient
 from easypy.caching import cached_property
 from easypy.bunch import Bunch
 from easypy.exceptions import TException
@@ -39,7 +44,14 @@ from .logging import logger, init_logging
 from .utils import (
     patch_traceback_format,
     get_mount,
+    maybe_mounted,
+    invalidate_mounts,
+    scandir_by_inode,
+    json_loads,
+    json_dumps,
+    LazyPformat,
     normalize_mount_options,
+    merge_mount_options,
     parse_load_balancing_strategy,
     string_to_proto_timestamp
 )
@@ -47,8 +59,10 @@ from . import csi_pb2_grpc
 from .csi_pb2_grpc import ControllerServicer, NodeServicer, IdentityServicer
 from . import csi_types as types
 from .volume_builder import EmptyVolumeBuilder, VolumeFromSnapshotBuilder, TestVolumeBuilder
-from .exceptions import Abort, ApiError, MissingParameter, MountFailed, VolumeAlreadyExists, SourceNotFound
-from .vms_session import VmsSession, TestVmsSession
+from .exceptions import (
+    Abort, ApiError, MissingParameter, MountFailed, VolumeAlreadyExists, SourceNotFound, InvalidPageLink
+)
+from .vms_session import get_vms_session
 from .configuration import Config
 
 
@@ -76,56 +90,95 @@ SUPPORTED_ACCESS = [
     # types.AccessModeType.MULTI_NODE_SINGLE_WRITER,
     types.AccessModeType.MULTI_NODE_MULTI_WRITER,
 ]
+_SUPPORTED_ACCESS_SET = frozenset(SUPPORTED_ACCESS)
 
+# List* RPCs are unary, so a single response is bounded by paging when the CO doesn't limit it by itself
+DEFAULT_PAGE_SIZE = 250
 
-def mount(src, tgt, flags=""):
-    executable = cmd.mount
+_BRACKETS_TABLE = str.maketrans("", "", "[]")  # for stripping brackets off mount options
+
+
+@lru_cache(maxsize=None)
+def _local_command(name):
+    """Resolve a local executable once instead of going through plumbum's `cmd` lookup on every call"""
+    return local[name]
+
+
+@lru_cache(maxsize=16)
+def _mount_flags(flags, mock_vast=False):
     flags = [f.strip() for f in flags.split(",")]
-    if CONF.mock_vast:
+    if mock_vast:
         flags += "port=2049,nolock,vers=3".split(",")
-    flags = list(filter(None, flags))
+    return tuple(filter(None, flags))
+
+
+def mount(src, tgt, flags=""):
+    executable = _local_command("mount")
+    flags = _mount_flags(flags, mock_vast=CONF.mock_vast)
     if flags:
         executable = executable["-o", ",".join(flags)]
     try:
         executable['-v', src, tgt] & logger.pipe_info("mount >>")
     except ProcessExecutionError as exc:
         raise MountFailed(detail=exc.stderr, src=src, tgt=tgt, mount_options=flags)
+    finally:
+        invalidate_mounts()
+
+
+@lru_cache(maxsize=None)
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+    return libc
+
+
+def umount(tgt):
+    """
+    Unmount `tgt` with the umount2 syscall rather than spawning the `umount` executable.
+    Returns False if `tgt` is not a mount point.
+    """
+    try:
+        if _libc().umount2(os.fsencode(str(tgt)), 0) == 0:
+            return True
+        if (errno := ctypes.get_errno()) == EINVAL:
+            return False
+        raise OSError(errno, os.strerror(errno), str(tgt))
+    finally:
+        invalidate_mounts()
 
 
 def _validate_capabilities(capabilities):
     for capability in capabilities:
-        if capability.access_mode.mode not in SUPPORTED_ACCESS:
+        if (mode := capability.access_mode.mode) not in _SUPPORTED_ACCESS_SET:
             raise Abort(
                 INVALID_ARGUMENT,
-                f"Unsupported access mode: {capability.access_mode.mode} (use {SUPPORTED_ACCESS})",
+                f"Unsupported access mode: {mode} (use {SUPPORTED_ACCESS})",
             )
-
-        if not capability.HasField("mount"):
-            pass
-        elif not capability.mount.fs_type:
-            pass
-        elif capability.mount.fs_type != "ext4":
+        if capability.HasField("mount") and (fs_type := capability.mount.fs_type) and fs_type != "ext4":
             raise Abort(
                 INVALID_ARGUMENT,
-                f"Unsupported file system type: {capability.mount.fs_type}",
+                f"Unsupported file system type: {fs_type}",
             )
 
 
 class Instrumented:
 
     SILENCED = ["Probe", "NodeGetCapabilities"]
+    _SERVICER_METHODS: ClassVar[dict] = {}  # servicer class -> names of its RPC methods
 
     @classmethod
     def logged(cls, func):
 
         method = func.__name__
-        log = logger.debug if (method in cls.SILENCED) else logger.info
+        level = logging.DEBUG if (method in cls.SILENCED) else logging.INFO
 
-        parameters = inspect.signature(func).parameters
-        required_params = {
-            name for name, p in parameters.items() if p.default is p.empty
-        }
-        required_params.discard("self")
+        # read the required parameters straight off the code object, which is much cheaper than inspect.signature
+        code = func.__code__
+        args = code.co_varnames[:code.co_argcount]
+        kwonly = code.co_varnames[code.co_argcount:code.co_argcount + code.co_kwonlyargcount]
+        required_params = set(args[:len(args) - len(func.__defaults__ or ())])
+        required_params.update(name for name in kwonly if name not in (func.__kwdefaults__ or {}))
+        required_params -= {"self", "request", "context"}
 
         func = kwargs_resilient(func)
 
@@ -133,13 +186,12 @@ class Instrumented:
         def wrapper(self, request, context):
             peer = context.peer()
             params = {fld.name: value for fld, value in request.ListFields()}
-            missing = required_params - {"request", "context"} - set(params)
-
-            log(f"{peer} >>> {method}:")
+            missing = required_params - set(params) if required_params else None
 
             if params:
-                for line in pformat(params).splitlines():
-                    log(f"    {line}")
+                logger.log(level, "%s >>> %s:\n%s", peer, method, LazyPformat(params))
+            else:
+                logger.log(level, "%s >>> %s:", peer, method)
 
             try:
                 if missing:
@@ -173,19 +225,24 @@ class Instrumented:
                 text = str(exc)
                 context.abort(UNKNOWN, f"[{method}]: {text}")
             if ret:
-                log(f"{peer} <<< {method}:")
-                for line in pformat(ret).splitlines():
-                    log(f"    {line}")
-            log(f"{peer} --- {method}: Done")
+                logger.log(level, "%s <<< %s:\n%s", peer, method, LazyPformat(ret))
+            logger.log(level, "%s --- %s: Done", peer, method)
             return ret
 
         return wrapper
 
+    @classmethod
+    def _servicer_methods(cls, servicer):
+        """Names of the public RPC methods of the generated servicer base class (computed once per servicer)"""
+        if (names := cls._SERVICER_METHODS.get(servicer)) is None:
+            names = cls._SERVICER_METHODS[servicer] = [
+                name for name, _ in inspect.getmembers(servicer, inspect.isfunction) if not name.startswith("_")
+            ]
+        return names
+
     @classmethod
     def __init_subclass__(cls):
-        for name, _ in inspect.getmembers(cls.__base__, inspect.isfunction):
-            if name.startswith("_"):
-                continue
+        for name in cls._servicer_methods(cls.__base__):
             func = getattr(cls, name)
             setattr(cls, name, cls.logged(func))
         super().__init_subclass__()
@@ -210,7 +267,9 @@ class Identity(IdentityServicer, Instrumented):
             vendor_version=CONF.plugin_version,
         )
 
-    def GetPluginCapabilities(self, request, context):
+    @cached_property
+    def _capabilities_resp(self):
+        # capabilities are populated at startup, before the server begins handling requests
         return types.CapabilitiesResp(
             capabilities=[
                 types.Capability(service=types.Service(type=cap))
@@ -218,6 +277,9 @@ class Identity(IdentityServicer, Instrumented):
             ]
         )
 
+    def GetPluginCapabilities(self, request, context):
+        return self._capabilities_resp
+
     def Probe(self, request, context):
         if self.node:
             return types.ProbeRespOK
@@ -253,26 +315,24 @@ class Controller(ControllerServicer, Instrumented):
         # types.CtrlCapabilityType.CLONE_VOLUME,
         # types.CtrlCapabilityType.PUBLISH_READONLY,
     ]
-
-    @cached_property
+    CAPABILITIES_RESP = types.CtrlCapabilityResp(
+        capabilities=[
+            types.CtrlCapability(rpc=types.CtrlCapability.RPC(type=rpc))
+            for rpc in CAPABILITIES
+        ]
+    )
+
+    # Mock snapshots (X_CSI_MOCK_VAST) are kept in memory unless `CONF.fake_snapshots_in_memory` is disabled,
+    # in which case they are serialized to files in `CONF.fake_snapshot_store`.
+    _fake_snapshots: ClassVar[dict] = {}  # snapshot id -> (sequence number, snapshot)
+    _fake_snapshot_seq: ClassVar[count] = count(1)
+
+    @property
     def vms_session(self):
-        session_class = TestVmsSession if CONF.mock_vast else VmsSession
-        session = session_class()
-        logger.info(
-            "Custom ssl certificates uploaded for use in VMS session."
-            if CONF.vms_ssl_cert.exists() else
-            "VMS session started without ssl certificates."
-        )
-        session.refresh_auth_token()
-        return session
+        return get_vms_session()
 
     def ControllerGetCapabilities(self):
-        return types.CtrlCapabilityResp(
-            capabilities=[
-                types.CtrlCapability(rpc=types.CtrlCapability.RPC(type=rpc))
-                for rpc in self.CAPABILITIES
-            ]
-        )
+        return self.CAPABILITIES_RESP
 
     def ValidateVolumeCapabilities(
         self,
@@ -302,16 +362,20 @@ class Controller(ControllerServicer, Instrumented):
             raise Abort(ABORTED, "Invalid starting_token")
 
         if starting_token:
-            ret = self.vms_session.list_quotas(max_entries=max_entries)
+            try:
+                ret = self.vms_session.get_by_token(token=starting_token)
+            except InvalidPageLink:
+                raise Abort(ABORTED, "Invalid starting_token")
         else:
-            ret = self.vms_session.get_by_token(token=starting_token)
+            ret = self.vms_session.list_quotas(max_entries=max_entries or DEFAULT_PAGE_SIZE)
+        Entry, Volume, to_volume_id = types.ListResp.Entry, types.Volume, self._to_volume_id
         return types.ListResp(
-            next_token=ret.next_token,
+            next_token=ret.next,
             entries=[
-                types.ListResp.Entry(
-                    volume=types.Volume(
+                Entry(
+                    volume=Volume(
                         capacity_bytes=quota.hard_limit,
-                        volume_id=self._to_volume_id(quota.path),
+                        volume_id=to_volume_id(quota.path),
                         volume_context=dict(quota_id=str(quota.id)),
                     )
                 )
@@ -336,7 +400,7 @@ class Controller(ControllerServicer, Instrumented):
             mount_flags = mount_capability.mount.mount_flags
             mount_options = ",".join(mount_flags)
             # normalize mount options (remove spaces, brackets etc)
-            mount_options = ",".join(re.sub(r"[\[\]]", "", mount_options).replace(",", " ").split())
+            mount_options = ",".join(mount_options.translate(_BRACKETS_TABLE).replace(",", " ").split())
         except StopIteration:
             mount_options = ""
 
@@ -450,7 +514,7 @@ class Controller(ControllerServicer, Instrumented):
                 raise
             finally:
                 if mounted:
-                    cmd.umount['-v', tmpdir] & logger.pipe_info("umount >>", retcode=None)  # don't fail if not mounted
+                    _local_command("umount")['-v', tmpdir] & logger.pipe_info("umount >>", retcode=None)  # don't fail if not mounted
                 os.remove(tmpdir['.csi-unmounted'])  # will fail if still mounted somehow
                 os.rmdir(tmpdir)  # will fail if not empty directory
 
@@ -468,6 +532,7 @@ class Controller(ControllerServicer, Instrumented):
                     raise
             logger.info(f"Data removed: {quota.path}")
 
+            # the quota must go last - it is how a retried DeleteVolume finds the volume again
             self.vms_session.delete_view_by_path(quota.path)
             logger.info(f"View removed: {quota.path}")
 
@@ -488,7 +553,10 @@ class Controller(ControllerServicer, Instrumented):
         else:
             root_export = local.path(volume_context["root_export"])
 
-        load_balancing = parse_load_balancing_strategy(volume_context.get("load_balancing", CONF.load_balancing))
+        if load_balancing := volume_context.get("load_balancing"):
+            load_balancing = parse_load_balancing_strategy(load_balancing)
+        else:
+            load_balancing = CONF.load_balancing_strategy
 
         # Build export path for snapshot or volume
         if snapshot_base_path := volume_context.get("snapshot_base_path"):
@@ -501,7 +569,8 @@ class Controller(ControllerServicer, Instrumented):
             export_path = str(root_export[volume_id])
 
         vip_pool_name = None if CONF.mock_vast else volume_context["vip_pool_name"]
-        if not (quota := self.vms_session.get_quota(quota_path_fragment)):
+        quota_path = root_export[quota_path_fragment]
+        if not (quota := self.vms_session.get_quota(quota_path_fragment, path=quota_path)):
             raise Abort(NOT_FOUND, f"Unknown volume: {quota_path_fragment}")
 
         if CONF.csi_sanity_test and CONF.node_id != node_id:
@@ -556,15 +625,12 @@ class Controller(ControllerServicer, Instrumented):
 
         if CONF.mock_vast:
 
-            try:
-                with CONF.fake_snapshot_store[name].open("rb") as f:
-                    snp = types.Snapshot()
-                    snp.ParseFromString(f.read())
+            if snp := self._get_fake_snapshot(name):
                 if snp.source_volume_id != volume_id:
                     raise Abort(
                         ALREADY_EXISTS, f"Snapshot name '{name}' is already taken"
                     )
-            except FileNotFoundError:
+            else:
                 ts = types.Timestamp()
                 ts.FromDatetime(datetime.utcnow())
                 snp = types.Snapshot(
@@ -574,8 +640,7 @@ class Controller(ControllerServicer, Instrumented):
                     creation_time=ts,
                     ready_to_use=True,
                 )
-                with CONF.fake_snapshot_store[name].open("wb") as f:
-                    f.write(snp.SerializeToString())
+                self._save_fake_snapshot(snp)
         else:
             # Create snapshot using the same path as quota has.
             path = quota.path
@@ -593,21 +658,24 @@ class Controller(ControllerServicer, Instrumented):
                 snap = self.vms_session.ensure_snapshot(snapshot_name=snapshot_name, path=path, tenant_id=tenant_id)
             except ApiError as exc:
                 handled = False
-                if exc.response.status_code == 400:
+                response = exc.response
+                if (
+                    response.status_code == 400
+                    and response.headers.get("Content-Type", "").startswith("application/json")
+                ):
                     try:
-                        [(k, [v])] = exc.response.json().items()
-                    except (ValueError, JSONDecodeError):
-                        pass
-                    else:
-                        if (k, v) == ("name", "This field must be unique."):
-                            snap = self.vms_session.get_snapshot(snapshot_name=snapshot_name)
-                            if snap.path != path:
-                                raise Abort(
-                                    ALREADY_EXISTS,
-                                    f"Snapshot name '{name}' is already taken",
-                                ) from None
-                            else:
-                                handled = True
+                        errors = json_loads(response.content)
+                    except ValueError:
+                        errors = None
+                    if isinstance(errors, dict) and errors.get("name") == ["This field must be unique."]:
+                        snap = self.vms_session.get_snapshot(snapshot_name=snapshot_name)
+                        if snap.path != path:
+                            raise Abort(
+                                ALREADY_EXISTS,
+                                f"Snapshot name '{name}' is already taken",
+                            ) from None
+                        else:
+                            handled = True
                 if not handled:
                     raise Abort(INVALID_ARGUMENT, str(exc))
 
@@ -623,7 +691,7 @@ class Controller(ControllerServicer, Instrumented):
 
     def DeleteSnapshot(self, snapshot_id):
         if CONF.mock_vast:
-            CONF.fake_snapshot_store[snapshot_id].delete()
+            self._delete_fake_snapshot(snapshot_id)
         else:
             snapshot = self.vms_session.get_snapshot(snapshot_id=snapshot_id)
             self.vms_session.delete_snapshot(snapshot_id)
@@ -637,11 +705,63 @@ class Controller(ControllerServicer, Instrumented):
 
         return types.DeleteSnapResp()
 
+    @classmethod
+    def _get_fake_snapshot(cls, snapshot_id):
+        """Get mock snapshot by id. Return None if not found."""
+        if CONF.fake_snapshots_in_memory:
+            if item := cls._fake_snapshots.get(snapshot_id):
+                return item[1]
+        elif "/" not in snapshot_id and (path := CONF.fake_snapshot_store[snapshot_id]).is_file():
+            return types.Snapshot.FromString(path.read(mode="rb"))
+
+    @classmethod
+    def _save_fake_snapshot(cls, snap):
+        if CONF.fake_snapshots_in_memory:
+            cls._fake_snapshots[snap.snapshot_id] = next(cls._fake_snapshot_seq), snap
+        else:
+            CONF.fake_snapshot_store[snap.snapshot_id].write(snap.SerializeToString(), mode="wb")
+
+    @classmethod
+    def _delete_fake_snapshot(cls, snapshot_id):
+        if CONF.fake_snapshots_in_memory:
+            cls._fake_snapshots.pop(snapshot_id, None)
+        else:
+            CONF.fake_snapshot_store[snapshot_id].delete()
+
+    @classmethod
+    def _iter_fake_snapshots(cls, after=0):
+        """
+        Yield (key, snapshot) pairs of mock snapshots ordered by key, skipping keys up to `after`.
+        The key (sequence number in memory, inode on disk) is used as pagination token.
+        """
+        if CONF.fake_snapshots_in_memory:
+            snaps = list(cls._fake_snapshots.values())  # insertion order is sequence order
+            yield from islice(snaps, bisect_right([seq for seq, _ in snaps], after), None)
+        else:
+            for inode, dentry in scandir_by_inode(CONF.fake_snapshot_store, os.DirEntry.is_file, after=after):
+                yield inode, types.Snapshot.FromString(local.path(dentry.path).read(mode="rb"))
+
     @classmethod
     def _to_volume_id(cls, path):
-        vol_id = str(local.path(path).relative_to(CONF.sanity_test_nfs_export))
+        # VMS paths are normalized already, so plain string slicing is enough here
+        prefix = CONF.nfs_export_prefix
+        path = path.rstrip("/")
+        if not path.startswith(prefix):
+            return None
+        vol_id = path[len(prefix):]
         return None if vol_id.startswith("..") else vol_id
 
+    @classmethod
+    def _to_snapshot(cls, snap):
+        """Convert VMS snapshot to csi Snapshot"""
+        return types.Snapshot(
+            size_bytes=0,  # indicates 'unspecified'
+            snapshot_id=str(snap.id),
+            source_volume_id=cls._to_volume_id(snap.path) or "n/a",
+            creation_time=string_to_proto_timestamp(snap.created),
+            ready_to_use=True,
+        )
+
     def ListSnapshots(
         self,
         max_entries=None,
@@ -650,65 +770,48 @@ class Controller(ControllerServicer, Instrumented):
         snapshot_id=None,
     ):
         if CONF.mock_vast:
-            starting_inode = int(starting_token) if starting_token else 0
-            snaps = (d for d in os.scandir(CONF.fake_snapshot_store) if d.is_file())
-            snaps = sorted(snaps, key=lambda d: d.inode())
-            logger.info(f"Got {len(snaps)} snapshots in {CONF.fake_snapshot_store}")
-            start_idx = 0
-
-            logger.info(f"Skipping to {starting_inode}")
-            for start_idx, d in enumerate(snaps):
-                if d.inode() > starting_inode:
+            if snapshot_id:
+                # snapshots are stored by their id so there is no need to scan the whole store
+                snap = self._get_fake_snapshot(snapshot_id)
+                if not snap or (source_volume_id and snap.source_volume_id != source_volume_id):
+                    return types.ListSnapResp()
+                return types.ListSnapResp(entries=[types.SnapEntry(snapshot=snap)])
+
+            starting_key = int(starting_token) if starting_token else 0
+            logger.info(f"Skipping to {starting_key}")
+
+            # only load snapshots up to the end of the requested page
+            entries = []
+            next_token = last_key = None
+            for key, snap in self._iter_fake_snapshots(after=starting_key):
+                if source_volume_id and snap.source_volume_id != source_volume_id:
+                    continue
+                if max_entries and len(entries) == max_entries:
+                    next_token = str(last_key)
                     break
-            del snaps[:start_idx]
+                entries.append(types.SnapEntry(snapshot=snap))
+                last_key = key
 
-            def to_snapshot(dentry):
-                with local.path(dentry.path).open("rb") as f:
-                    snap = types.Snapshot()
-                    snap.ParseFromString(f.read())
-                if source_volume_id and snap.source_volume_id != source_volume_id:
-                    return
-                if snapshot_id and snap.snapshot_id != snapshot_id:
-                    return
-                return snap, dentry.inode()
-
-            snaps = list(filter(None, map(to_snapshot, snaps)))
-            remain = 0
-            if max_entries:
-                remain = at_least(0, len(snaps) - max_entries)
-                snaps = snaps[:max_entries]
-
-            next_token = str(snaps[-1][1]) if remain else None
-            return types.ListSnapResp(
-                next_token=next_token,
-                entries=[types.SnapEntry(snapshot=snap) for snap, _ in snaps],
-            )
+            return types.ListSnapResp(next_token=next_token, entries=entries)
         else:
-            page_size = max_entries or 250
+            page_size = max_entries or DEFAULT_PAGE_SIZE
 
             if starting_token:
-                ret = self.vms_session.get_by_token(starting_token)
+                try:
+                    ret = self.vms_session.get_by_token(starting_token)
+                except InvalidPageLink:
+                    raise Abort(ABORTED, "Invalid starting_token")
             elif not snapshot_id:
-                ret = self.vms_session.snapshots(page_size=page_size)
+                ret = self.vms_session.snapshot_list(page_size=page_size)
             else:
                 snap = self.vms_session.snapshots(snapshot_id)
-                return types.ListSnapResp(next_token=None, entries=[types.SnapEntry(
-                    snapshot=types.Snapshot(
-                        size_bytes=0,  # indicates 'unspecified'
-                        snapshot_id=str(snap.id),
-                        source_volume_id=self._to_volume_id(snap.path) or "n/a",
-                        creation_time=string_to_proto_timestamp(snap.created),
-                        ready_to_use=True,
-                    ))])
-
-            return types.ListSnapResp(next_token=ret.next, entries=[types.SnapEntry(
-                snapshot=types.Snapshot(
-                    size_bytes=0,  # indicates 'unspecified'
-                    snapshot_id=str(snap.id),
-                    source_volume_id=self._to_volume_id(snap.path) or "n/a",
-                    creation_time=string_to_proto_timestamp(snap.created),
-                    ready_to_use=True,
-                )) for snap in ret.results])
+                return types.ListSnapResp(next_token=None, entries=[types.SnapEntry(snapshot=self._to_snapshot(snap))])
+
+            SnapEntry, to_snapshot = types.SnapEntry, self._to_snapshot
+            return types.ListSnapResp(
+                next_token=ret.next,
+                entries=[SnapEntry(snapshot=to_snapshot(snap)) for snap in ret.results],
+            )
 
 
 ################################################################
@@ -724,14 +827,15 @@ class Node(NodeServicer, Instrumented):
         # types.NodeCapabilityType.STAGE_UNSTAGE_VOLUME,
         # types.NodeCapabilityType.GET_VOLUME_STATS,
     ]
+    CAPABILITIES_RESP = types.NodeCapabilityResp(
+        capabilities=[
+            types.NodeCapability(rpc=types.NodeCapability.RPC(type=rpc))
+            for rpc in CAPABILITIES
+        ]
+    )
 
     def NodeGetCapabilities(self):
-        return types.NodeCapabilityResp(
-            capabilities=[
-                types.NodeCapability(rpc=types.NodeCapability.RPC(type=rpc))
-                for rpc in self.CAPABILITIES
-            ]
-        )
+        return self.CAPABILITIES_RESP
 
     def NodePublishVolume(
         self,
@@ -792,11 +896,11 @@ class Node(NodeServicer, Instrumented):
         mount_spec = f"{nfs_server_ip}:{export_path}"
 
         _validate_capabilities([volume_capability])
-        target_path = local.path(target_path)
+        target_path = Path(target_path)
 
-        if not target_path.is_dir():
-            pass
-        elif found_mount := get_mount(target_path):
+        # a couple of lstat calls rule out the common 'not published yet' case before consulting the mount table,
+        # which is then read fresh - a stale 'not mounted' would have us mount again on top of the live volume
+        if maybe_mounted(target_path) and (found_mount := get_mount(target_path, fresh=True)):
             opts = set(found_mount.opts.split(","))
             is_readonly = "ro" in opts
             if found_mount.device != mount_spec:
@@ -810,59 +914,72 @@ class Node(NodeServicer, Instrumented):
                     f"Volume already mounted as {'readonly' if is_readonly else 'readwrite'}",
                 )
             else:
-                logger.info(f"{volume_id} is already mounted: {found_mount}")
+                logger.info("%s is already mounted: %s", volume_id, found_mount)
                 return types.NodePublishResp()
 
-        target_path.mkdir()
-        with target_path[".vast-csi-meta"].open("w") as f:
-            json.dump(dict(volume_id=volume_id, is_ephemeral=is_ephemeral), f)
-        logger.info(f"created: {target_path}")
+        os.makedirs(target_path, exist_ok=True)
+        fd = os.open(target_path / ".vast-csi-meta", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, json_dumps(dict(volume_id=volume_id, is_ephemeral=bool(is_ephemeral))))
+        finally:
+            os.close(fd)
+        logger.info("created: %s", target_path)
 
         flags = ["ro"] if readonly else []
         if volume_capability.mount.mount_flags:
             flags += volume_capability.mount.mount_flags
         else:
             flags += normalize_mount_options(volume_context.get("mount_options", ""))
+        flags = merge_mount_options(flags, CONF.default_mount_options)
         mount(mount_spec, target_path, flags=",".join(flags))
-        logger.info(f"mounted: {target_path} flags: {flags}")
+        logger.info("mounted: %s flags: %s", target_path, flags)
         return types.NodePublishResp()
 
     def NodeUnpublishVolume(self, target_path):
-        target_path = local.path(target_path)
+        target_path = Path(target_path)
 
-        if not target_path.exists():
-            logger.info(f"{target_path} does not exist - no need to remove")
+        try:
+            os.lstat(target_path)
+            exists = True
+        except FileNotFoundError:
+            exists = False
+        except OSError as exc:
+            # eg. ESTALE on a stale NFS mount - it is there and still needs to be unmounted
+            logger.info("Can't stat %s (%s) - proceeding to unmount", target_path, exc)
+            exists = True
+
+        if not exists:
+            logger.info("%s does not exist - no need to remove", target_path)
         else:
             # make sure we're really unmounted before we delete anything
             for i in range(CONF.unmount_attempts):
-                if not get_mount(target_path):
-                    logger.info(f"{target_path} is not mounted")
+                if not (maybe_mounted(target_path) and get_mount(target_path, fresh=True)):
+                    logger.info("%s is not mounted", target_path)
+                    break
+                if not umount(target_path):
+                    logger.info("umount failed - %s is not mounted (race?)", target_path)
                     break
-                try:
-                    local.cmd.umount(target_path)
-                except ProcessExecutionError as exc:
-                    if "not mounted" in exc.stderr:
-                        logger.info(f"umount failed - {target_path} is not mounted (race?)")
-                        break
-                    raise
             else:
                 raise Abort(
                     UNKNOWN,
                     f"Stuck in unmount loop of {target_path} too many times ({CONF.unmount_attempts})",
                 )
 
-            logger.info(f"Deleting {target_path}")
-            if target_path[".vast-csi-meta"].exists():
-                with target_path[".vast-csi-meta"].open("r") as f:
-                    meta = json.load(f)
-                if meta.get("is_ephemeral"):
-                    controller = Controller()
-                    controller.DeleteVolume.__wrapped__(controller, meta["volume_id"])
-
-            if target_path[".vast-csi-meta"].exists():
-                os.remove(target_path[".vast-csi-meta"])
-            os.rmdir(target_path)  # don't use plumbum's .delete to avoid the dangerous rmtree
-            logger.info(f"{target_path} removed successfully")
+            logger.info("Deleting %s", target_path)
+            meta_path = target_path / ".vast-csi-meta"
+            try:
+                with open(meta_path, "rb") as f:
+                    meta = json_loads(f.read())
+            except FileNotFoundError:
+                meta = None
+            if meta and meta.get("is_ephemeral"):
+                controller = Controller()
+                controller.DeleteVolume.__wrapped__(controller, meta["volume_id"])
+
+            if meta is not None:
+                os.unlink(meta_path)
+            os.rmdir(target_path)  # never delete recursively here, to avoid the dangerous rmtree
+            logger.info("%s removed successfully", target_path)
         return types.NodeUnpublishResp()
 
     def NodeGetInfo(self):
@@ -876,19 +993,16 @@ class Node(NodeServicer, Instrumented):
 ################################################################
 
 
-def serve():
-    patch_traceback_format()
-    global CONF
-    CONF = Config()
-    init_logging(level=CONF.log_level)
-    logger.info("%s: %s (%s)", CONF.plugin_name, CONF.plugin_version, CONF.git_commit)
-
-    if not CONF.ssl_verify:
-        import urllib3
-
-        urllib3.disable_warnings()
-
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=CONF.worker_threads))
+def _start_server(options=()):
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=CONF.worker_threads),
+        maximum_concurrent_rpcs=CONF.max_concurrent_rpcs,
+        options=[
+            ("grpc.max_concurrent_streams", 128),
+            ("grpc.keepalive_time_ms", 30000),
+            *options,
+        ],
+    )
 
     identity = Identity()
     csi_pb2_grpc.add_IdentityServicer_to_server(identity, server)
@@ -899,8 +1013,6 @@ def serve():
         identity.controller = Controller()
         identity.capabilities.append(types.ServiceType.CONTROLLER_SERVICE)
         csi_pb2_grpc.add_ControllerServicer_to_server(identity.controller, server)
-        CONF.fake_quota_store.mkdir()
-        CONF.fake_snapshot_store.mkdir()
 
     if CONF.mode in {NODE, CONTROLLER_AND_NODE}:
         identity.node = Node()
@@ -908,6 +1020,73 @@ def serve():
 
     server.add_insecure_port(CONF.endpoint)
     server.start()
+    return server
 
-    logger.info(f"Server started as '{CONF.mode}', listening on {CONF.endpoint}, spawned threads {CONF.worker_threads}")
-    server.wait_for_termination()
+
+def serve():
+    patch_traceback_format()
+    global CONF
+    CONF = Config()
+    init_logging(level=CONF.log_level)
+    logger.info("%s: %s (%s)", CONF.plugin_name, CONF.plugin_version, CONF.git_commit)
+
+    if not CONF.ssl_verify:
+        import urllib3
+
+        urllib3.disable_warnings()
+
+    if CONF.mode in {CONTROLLER, CONTROLLER_AND_NODE}:
+        CONF.fake_quota_store.mkdir()
+        CONF.fake_snapshot_store.mkdir()
+
+    processes = CONF.server_processes
+    if processes > 1 and CONF.endpoint.startswith("unix:"):
+        logger.warning("Can't share unix socket %s between processes - serving from a single process", CONF.endpoint)
+        processes = 1
+
+    if processes == 1:
+        server = _start_server()
+        logger.info("Server started as '%s', listening on %s, spawned threads %s, max concurrent rpcs %s",
+                    CONF.mode, CONF.endpoint, CONF.worker_threads, CONF.max_concurrent_rpcs)
+        server.wait_for_termination()
+        return
+
+    _serve_forked(processes)
+
+
+def _serve_forked(processes):
+    """
+    Serve from `processes` forked workers sharing the endpoint via SO_REUSEPORT.
+    The workers are forked before any gRPC server (or VMS session) exists, so each gets its own.
+    Once any worker exits the others are stopped and we exit with an error, to let the pod be restarted
+    rather than keep running with fewer workers.
+    """
+    workers = []
+    for _ in range(processes):
+        if pid := os.fork():
+            workers.append(pid)
+            continue
+        exit_code = 1
+        try:
+            server = _start_server(options=[("grpc.so_reuseport", 1)])
+            logger.info("Server worker started as '%s', listening on %s, spawned threads %s, max concurrent rpcs %s",
+                        CONF.mode, CONF.endpoint, CONF.worker_threads, CONF.max_concurrent_rpcs)
+            server.wait_for_termination()
+            exit_code = 0
+        except BaseException:
+            logger.exception("Server worker failed")
+        finally:
+            os._exit(exit_code)
+
+    logger.info("Started %s server processes: %s", processes, workers)
+    pid, status = os.wait()
+    logger.error("Server worker %s exited with %s - stopping the other workers", pid, os.waitstatus_to_exitcode(status))
+    workers.remove(pid)
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers:
+        os.waitpid(pid, 0)
+    sys.exit(1)
@@ -1,5 +1,11 @@
+import os
 import re
+from bisect import bisect_right
+from operator import itemgetter
 from datetime import datetime
+from pprint import pformat
+from threading import Lock
+from time import monotonic
 from ipaddress import summarize_address_range, ip_address
 from requests.exceptions import HTTPError  # noqa
 
@@ -13,6 +19,17 @@ from easypy.tokens import (
 )
 from . import csi_types as types
 
+try:
+    from orjson import loads as json_loads, dumps as _json_dumps
+except ImportError:  # orjson is an optional speedup
+    from json import loads as json_loads, dumps as _json_dumps
+
+
+def json_dumps(obj) -> bytes:
+    """Serialize to JSON bytes, falling back to str() for values such as paths"""
+    data = _json_dumps(obj, default=str)
+    return data.encode() if isinstance(data, str) else data
+
 
 LOAD_BALANCING_STRATEGIES = {ROUNDROBIN, RANDOM}
 
@@ -31,11 +48,90 @@ def clean_path(path):
     return path
 
 
-def get_mount(target_path):
+class LazyPformat:
+    """
+    Pretty-print `obj` (indented, one line per row) only when converted to string.
+    Pass it as a logging argument so the formatting is skipped for records that are not emitted.
+    """
+
+    def __init__(self, obj, indent="    "):
+        self.obj = obj
+        self.indent = indent
+
+    def __str__(self):
+        return "\n".join(f"{self.indent}{line}" for line in pformat(self.obj).splitlines())
+
+
+MOUNTS_CACHE_TTL = 0.25
+_mounts_lock = Lock()
+_mounts_cache = (0.0, None)  # (monotonic expiry time, {mountpoint: partition})
+_mounts_generation = 0  # bumped by every invalidation
+
+
+def _get_mounts(fresh=False):
+    global _mounts_cache
+    with _mounts_lock:
+        expiry, mounts = _mounts_cache
+        generation = _mounts_generation
+    if not fresh and mounts is not None and monotonic() < expiry:
+        return mounts
+
     import psutil
+    mounts = {}
     for m in psutil.disk_partitions(all=True):
-        if m.mountpoint == target_path:
-            return m
+        mounts.setdefault(m.mountpoint, m)
+
+    with _mounts_lock:
+        # a mount or umount that completed while we were reading may be missing from this table - don't cache it
+        if generation == _mounts_generation:
+            _mounts_cache = (monotonic() + MOUNTS_CACHE_TTL, mounts)
+    return mounts
+
+
+def invalidate_mounts():
+    """Drop the cached mount table, to be called after mounting or unmounting"""
+    global _mounts_cache, _mounts_generation
+    with _mounts_lock:
+        _mounts_cache = (0.0, None)
+        _mounts_generation += 1
+
+
+def get_mount(target_path, fresh=False):
+    """
+    Find the mount at `target_path` in the mount table.
+    The table is cached briefly; pass `fresh=True` where a stale answer is not acceptable
+    (eg. before deleting a directory that might still be mounted).
+    """
+    return _get_mounts(fresh=fresh).get(str(target_path))
+
+
+def maybe_mounted(path) -> bool:
+    """
+    Cheap check (two `lstat` calls) whether `path` may be a mount point, to skip the mount table lookup.
+    Returns False only when `path` certainly isn't one. Unlike `os.path.ismount`, stat errors such as
+    a stale NFS handle count as 'maybe', so that callers still consult the mount table.
+    """
+    try:
+        st = os.lstat(path)
+        parent = os.lstat(os.path.join(path, os.pardir))
+    except FileNotFoundError:
+        return False
+    except OSError:
+        return True
+    return st.st_dev != parent.st_dev or st.st_ino == parent.st_ino
+
+
+def scandir_by_inode(path, predicate, after=0):
+    """
+    List entries of `path` accepted by `predicate` (eg. `os.DirEntry.is_file`) as (inode, DirEntry) pairs
+    sorted by inode, skipping inodes up to `after`.
+    Inodes come with the directory listing itself so no extra `stat` is needed, and since they are stable
+    they are used as pagination tokens for the mock listings.
+    """
+    entries = [(d.inode(), d) for d in os.scandir(path) if predicate(d)]
+    entries.sort(key=itemgetter(0))
+    del entries[:bisect_right([inode for inode, _ in entries], after)]
+    return entries
 
 
 def nice_format_traceback(self):
@@ -125,6 +221,21 @@ def normalize_mount_options(mount_options: str):
     return mount_options
 
 
+def _mount_option_key(option: str) -> str:
+    name = option.partition("=")[0]
+    name = "vers" if name == "nfsvers" else name
+    return name[2:] if name.startswith("no") else name
+
+
+def merge_mount_options(mount_options: list, defaults: list) -> list:
+    """
+    Append `defaults` to `mount_options`, skipping any default whose option is already set.
+    An option and its 'no' form (eg. 'ac' and 'noac') as well as 'vers' and 'nfsvers' count as the same option.
+    """
+    present = {_mount_option_key(opt) for opt in mount_options}
+    return mount_options + [opt for opt in defaults if _mount_option_key(opt) not in present]
+
+
 def string_to_proto_timestamp(str_ts: str):
     """Convert string to protobuf.Timestamp"""
     t = datetime.fromisoformat(str_ts.rstrip("Z")).timestamp()
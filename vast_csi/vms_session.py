@@ -1,11 +1,17 @@
 import os
-import json
+import logging
 import requests
-from pprint import pformat
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Lock
+from time import monotonic
 from typing import ClassVar
 from uuid import uuid4
 from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, HTTPError
+from urllib3.util.retry import Retry
 
 from easypy.bunch import Bunch
 from easypy.caching import cached_property
@@ -27,8 +33,8 @@ from plumbum import local, ProcessExecutionError
 
 from .logging import logger
 from .configuration import Config
-from .exceptions import ApiError, MountFailed, OperationNotSupported
-from .utils import parse_load_balancing_strategy, generate_ip_range
+from .exceptions import ApiError, MountFailed, OperationNotSupported, InvalidPageLink
+from .utils import parse_load_balancing_strategy, generate_ip_range, scandir_by_inode, LazyPformat, json_loads, json_dumps
 from . import csi_types as types
 
 
@@ -68,6 +74,16 @@ def requisite(semver: str, operation: str = None, ignore: bool = False):
     return dec
 
 
+def _endpoint(name):
+    """Create a method performing GET requests on the `name` REST endpoint"""
+
+    def func(self, *args, log_result=True, as_bunch=True, **params):
+        return self.request("get", name, *args, params=params, log_result=log_result, as_bunch=as_bunch)
+
+    func.__name__ = func.__qualname__ = name
+    return func
+
+
 class RESTSession(requests.Session):
     def __init__(self):
         super().__init__()
@@ -76,6 +92,23 @@ class RESTSession(requests.Session):
         self.config = Config()
         self.base_url = f"https://{self.config.vms_host}/api"
 
+        # Keep enough pooled connections for all gRPC workers to reuse, and retry on transient gateway errors.
+        # POST is not retried since it is not idempotent.
+        retries = Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=(502, 504),
+            allowed_methods=frozenset(["GET", "PATCH", "DELETE"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.config.worker_threads,
+            pool_maxsize=self.config.worker_threads * 2,
+            max_retries=retries,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
         if self.config.ssl_verify:
             self.ssl_verify = self.config.vms_ssl_cert if self.config.vms_ssl_cert.exists() else True
         else:
@@ -100,24 +133,34 @@ class RESTSession(requests.Session):
                 ))
 
     @retrying.debug(times=3, acceptable=retrying.Retry)
-    def request(self, verb, api_method, *args, params=None, log_result=True, **kwargs):
+    def request(self, verb, api_method, *args, params=None, log_result=True, as_bunch=True, **kwargs):
+        """
+        Perform a request to VMS REST API.
+        The response is returned as `Bunch`, or as the plain parsed JSON if `as_bunch` is False.
+        """
         verb = verb.upper()
-        api_method = api_method.strip("/")
-        url = [self.base_url, api_method]
-        url.extend(args)
-        url += [""]  # ensures a '/' at the end
-        url = "/".join(str(p) for p in url)
-        logger.info(f">>> [{verb}] {url}")
+        if api_method.startswith(("https://", "http://")):
+            # a complete link returned by VMS, such as the 'next' page of a listing. These come back to us from
+            # CSI clients as tokens, so make sure they point at VMS before sending our credentials along.
+            if not api_method.startswith(self.base_url + "/"):
+                raise InvalidPageLink(link=api_method, base_url=self.base_url)
+            url = api_method
+        else:
+            api_method = api_method.strip("/")
+            url = [self.base_url, api_method]
+            url.extend(args)
+            url += [""]  # ensures a '/' at the end
+            url = "/".join(str(p) for p in url)
+        logger.info(">>> [%s] %s", verb, url)
 
         if "data" in kwargs:
-            kwargs["data"] = json.dumps(kwargs["data"])
+            kwargs["data"] = json_dumps(kwargs["data"])
 
         if params or kwargs:
-            if log_result:
-                for line in pformat(dict(kwargs, params=params)).splitlines():
-                    logger.info(f"    {line}")
-            else:
+            if not log_result:
                 logger.info("*** request payload is hidden ***")
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s", LazyPformat(dict(kwargs, params=params)))
 
         ret = super().request(
             verb, url, verify=self.ssl_verify, params=params, **kwargs
@@ -130,29 +173,26 @@ class RESTSession(requests.Session):
             raise ApiError(response=ret)
         ret.raise_for_status()
 
-        logger.info(f"<<< [{verb}] {url}")
+        logger.info("<<< [%s] %s", verb, url)
         if ret.content:
-            ret = Bunch.from_dict(ret.json())
-            if log_result:
-                for line in pformat(ret).splitlines():
-                    logger.info(f"    {line}")
-            else:
+            ret = json_loads(ret.content)
+            if as_bunch:
+                ret = Bunch.from_dict(ret)
+            if log_result and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s", LazyPformat(ret))
+            elif not log_result:
                 size = len(ret) if isinstance(ret, (dict, tuple, list, str)) else '-'
-                logger.info(f"{type(ret)[{size}]}")
+                logger.info("%s[%s]", type(ret).__name__, size)
         else:
             ret = None
-        logger.info(f"--- [{verb}] {url}: Done")
+        logger.info("--- [%s] %s: Done", verb, url)
         return ret
 
     def __getattr__(self, attr):
         if attr.startswith("_"):
             raise AttributeError(attr)
 
-        def func(*args, log_result=True, **params):
-            return self.request("get", attr, *args, params=params, log_result=log_result)
-
-        func.__name__ = attr
-        func.__qualname__ = f"{self.__class__.__qualname__}.{attr}"
+        func = _endpoint(attr).__get__(self)
         setattr(self, attr, func)
         return func
 
@@ -164,7 +204,31 @@ class VmsSession(RESTSession):
     """
 
     TRASH_API_INTRODUCED: ClassVar[SemVer] = SemVer.loads("4.6.0")
-    _vip_round_robin_idx: ClassVar[int] = -1
+    QUOTA_CACHE_TTL: ClassVar[int] = 3  # seconds; enough to collapse repeated lookups within a single RPC
+    QUOTA_CACHE_SIZE: ClassVar[int] = 256
+    VIPPOOL_CACHE_TTL: ClassVar[int] = 30  # seconds
+    PREFETCH_TTL: ClassVar[int] = 3  # seconds; like QUOTA_CACHE_TTL, older prefetched pages are refetched
+    _vip_round_robin_counters: ClassVar[dict] = {}  # vip pool name -> itertools.count
+    _prefetch_pool: ClassVar[ThreadPoolExecutor] = None  # created on first use, so never before forking server workers
+    _prefetch_pool_lock: ClassVar[Lock] = Lock()
+
+    # Endpoints used by the driver are defined upfront instead of being generated by `__getattr__` on first use
+    clusters = _endpoint("clusters")
+    qospolicies = _endpoint("qospolicies")
+    quotas = _endpoint("quotas")
+    snapshots = _endpoint("snapshots")
+    viewpolicies = _endpoint("viewpolicies")
+    views = _endpoint("views")
+    vippools = _endpoint("vippools")
+    vms = _endpoint("vms")
+
+    def __init__(self):
+        super().__init__()
+        self._prefetched = {}  # token -> (expiry, future)
+        self._prefetch_lock = Lock()
+        self._quota_cache = OrderedDict()  # (volume_id, path) -> (expiry, quota), least recently used first
+        self._quota_cache_generation = 0  # bumped by every quota modification
+        self._quota_cache_lock = Lock()
 
     # ----------------------------
     # Clusters
@@ -314,25 +378,37 @@ class VmsSession(RESTSession):
 
     # ----------------------------
     # Vip pools
+    @timecache(VIPPOOL_CACHE_TTL)
+    def get_vippool(self, vip_pool_name: str):
+        """
+        Get vip pool by name along with the list of its ips.
+        Cached for a short while so that publishing volumes doesn't cost a VMS request each time.
+        Failed lookups (including unknown pool) are not cached.
+        """
+        if not (vippools := self.vippools(name=vip_pool_name, as_bunch=False)):
+            raise Exception(f"No VIP Pool named '{vip_pool_name}'")
+        vippool = vippools[0]
+        return vippool, generate_ip_range(vippool["ip_ranges"])
+
     def get_vip(self, vip_pool_name: str, tenant_id: int = None, load_balancing: str = None):
         """
         Get vip pool by provided vip_pool_name.
         Returns:
             One of ips from provided vip pool according to provided load balancing strategy.
         """
-        load_balancing = parse_load_balancing_strategy(load_balancing or self.config.load_balancing)
-        if not (vippools := self.vippools(name=vip_pool_name)):
-            raise Exception(f"No VIP Pool named '{vip_pool_name}'")
-
-        vippool = vippools[0]
-        if tenant_id and vippool.tenant_id != tenant_id:
-            raise Exception(f"Pool {vip_pool_name} belongs to different tenant with name {vippool.tenant_name}")
+        if load_balancing:
+            load_balancing = parse_load_balancing_strategy(load_balancing)
+        else:
+            load_balancing = self.config.load_balancing_strategy
+        vippool, vips = self.get_vippool(vip_pool_name)
+        if tenant_id and vippool["tenant_id"] != tenant_id:
+            raise Exception(f"Pool {vip_pool_name} belongs to different tenant with name {vippool.get('tenant_name')}")
 
-        vips = generate_ip_range(vippool.ip_ranges)
         assert vips, f"Pool {vip_pool_name} has no available vips"
         if load_balancing == ROUNDROBIN:
-            self._vip_round_robin_idx = (self._vip_round_robin_idx + 1) % len(vips)
-            vip = vips[self._vip_round_robin_idx]
+            # next() on itertools.count is atomic, so concurrent workers never pick the same index
+            counter = self._vip_round_robin_counters.setdefault(vip_pool_name, count())
+            vip = vips[next(counter) % len(vips)]
         elif load_balancing == RANDOM:
             vip = shuffled(vips)[0]
         else:
@@ -349,15 +425,56 @@ class VmsSession(RESTSession):
     # Quotas
     def list_quotas(self, max_entries) -> Bunch:
         """List of quotas"""
-        return self.quotas(page_size=max_entries)
+        return self._prefetch_next_page(self.quotas(page_size=max_entries))
 
     def create_quota(self, data):
         """Create new quota"""
-        return self.post("quotas", data=data)
+        try:
+            return self.post("quotas", data=data)
+        finally:
+            self._clear_quota_cache()
 
-    def get_quota(self, volume_id):
-        """Get quota by volume id."""
-        quotas = self.quotas(path__contains=volume_id)
+    def get_quota(self, volume_id, path=None):
+        """
+        Get quota by volume id.
+        When the full path of the volume is known pass it as `path`, so VMS does an exact match
+        instead of a substring search.
+        Results are cached briefly (up to QUOTA_CACHE_SIZE lookups) and invalidated by any quota modification.
+        Missing quotas are never cached, and neither is anything when serving from several processes, since
+        modifications made by one process can't invalidate the caches of the others.
+        """
+        if self.config.server_processes > 1:
+            return self._fetch_quota(volume_id, path)
+
+        key = (volume_id, str(path).rstrip("/") if path else None)
+        with self._quota_cache_lock:
+            expiry, quota = self._quota_cache.get(key, (0, None))
+            generation = self._quota_cache_generation
+            if monotonic() < expiry:
+                self._quota_cache.move_to_end(key)
+                return quota
+
+        quota = self._fetch_quota(volume_id, path)
+
+        with self._quota_cache_lock:
+            # don't cache a lookup that raced with a quota modification
+            if quota is not None and generation == self._quota_cache_generation:
+                self._quota_cache[key] = (monotonic() + self.QUOTA_CACHE_TTL, quota)
+                self._quota_cache.move_to_end(key)
+                while len(self._quota_cache) > self.QUOTA_CACHE_SIZE:
+                    self._quota_cache.popitem(last=False)
+        return quota
+
+    def _clear_quota_cache(self):
+        with self._quota_cache_lock:
+            self._quota_cache.clear()
+            self._quota_cache_generation += 1
+
+    def _fetch_quota(self, volume_id, path=None):
+        if path:
+            quotas = self.get_quotas_by_path(str(path))
+        else:
+            quotas = self.quotas(path__contains=volume_id)
         if not quotas:
             return
         elif len(quotas) > 1:
@@ -372,16 +489,22 @@ class VmsSession(RESTSession):
 
     def update_quota(self, quota_id, data):
         """Update existing quota."""
-        self.patch(f"quotas/{quota_id}", data=data)
+        try:
+            self.patch(f"quotas/{quota_id}", data=data)
+        finally:
+            self._clear_quota_cache()
 
     def delete_quota(self, quota_id):
         """Delete quota"""
-        self.delete(f"quotas/{quota_id}")
+        try:
+            self.delete(f"quotas/{quota_id}")
+        finally:
+            self._clear_quota_cache()
 
     # ----------------------------
     # Snapshots
     def snapshot_list(self, page_size):
-        return self.snapshots(page_size=page_size)
+        return self._prefetch_next_page(self.snapshots(page_size=page_size))
 
     def has_snapshots(self, path):
         path = path.rstrip("/") + "/"
@@ -425,7 +548,39 @@ class VmsSession(RESTSession):
         This method used to iterate over paginated resources (snapshots, quotas etc).
         Where after first request to resource list token for next page is returned.
         """
-        return self.get(token)
+        with self._prefetch_lock:
+            expiry, future = self._prefetched.pop(token, (0, None))
+        page = None
+        if future and monotonic() < expiry:
+            try:
+                page = future.result()
+            except Exception as exc:
+                logger.info("Prefetching %s failed (%r), fetching again", token, exc)
+        if page is None:
+            page = self.get(token)
+        return self._prefetch_next_page(page)
+
+    @classmethod
+    def _get_prefetch_pool(cls):
+        with cls._prefetch_pool_lock:
+            if cls._prefetch_pool is None:
+                cls._prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="vms-prefetch")
+            return cls._prefetch_pool
+
+    def _prefetch_next_page(self, page):
+        """
+        Start fetching the page following `page` in the background, so the next `get_by_token`
+        (usually the CO asking for the next page) doesn't wait a full round trip for it.
+        """
+        if page and (token := page.get("next")):
+            now = monotonic()
+            with self._prefetch_lock:
+                for stale in [t for t, (expiry, _) in self._prefetched.items() if expiry <= now]:
+                    del self._prefetched[stale]
+                if token not in self._prefetched:
+                    future = self._get_prefetch_pool().submit(self.get, token)
+                    self._prefetched[token] = (now + self.PREFETCH_TTL, future)
+        return page
 
 
 class TestVmsSession(RESTSession):
@@ -502,7 +657,7 @@ class TestVmsSession(RESTSession):
     def get_vip(self, *_, **__) -> str:
         return self.config.nfs_server
 
-    def get_quota(self, volume_id: str) -> "FakeQuota":
+    def get_quota(self, volume_id: str, path=None) -> "FakeQuota":
         """Create fake quota object which can simulate attributes of original Quota butch."""
         return self._to_mock_volume(volume_id)
 
@@ -520,23 +675,15 @@ class TestVmsSession(RESTSession):
         This method simulates behaviour of list_quotas but instead requesting quotas from remote cluster
         it gets list of local volumes that were created before.
         """
+        # same shape as a VMS page, with the last inode instead of a link as the 'next' token
         fields = Bunch.from_dict({
-            "next_token": None,
+            "next": None,
             "results": []
         })
 
         starting_inode = int(starting_token) if starting_token else 0
-        vols = (d for d in os.scandir(self._mock_mount) if d.is_dir())
-        vols = sorted(vols, key=lambda d: d.inode())
-        logger.info(f"Got {len(vols)} volumes in {self._mock_mount}")
-        start_idx = 0
-
-        logger.info(f"Skipping to {starting_inode}")
-        for start_idx, d in enumerate(vols):
-            if d.inode() > starting_inode:
-                break
-
-        del vols[:start_idx]
+        vols = scandir_by_inode(self._mock_mount, os.DirEntry.is_dir, after=starting_inode)
+        logger.info(f"Got {len(vols)} volumes in {self._mock_mount} after {starting_inode}")
 
         remain = 0
         if max_entries:
@@ -544,9 +691,9 @@ class TestVmsSession(RESTSession):
             vols = vols[:max_entries]
 
         if remain:
-            fields.next_token = str(vols[-1].inode())
+            fields.next = str(vols[-1][0])
 
-        fields.results = [self._to_mock_volume(vol.name) for vol in vols]
+        fields.results = [self._to_mock_volume(vol.name) for _, vol in vols]
         return fields
 
     def get_by_token(self, token):
@@ -583,3 +730,27 @@ class TestVmsSession(RESTSession):
     refresh_auth_token = _empty
     delete_folder = _empty
     is_trash_api_usable = _empty
+
+
+_vms_session = None
+_vms_session_lock = Lock()
+
+
+def get_vms_session():
+    """
+    Get the VMS session shared by all servicers and gRPC worker threads, creating it on first use.
+    Sharing it lets every request reuse the same pooled keep-alive connections and auth token.
+    """
+    global _vms_session
+    with _vms_session_lock:
+        if _vms_session is None:
+            config = Config()
+            session = (TestVmsSession if config.mock_vast else VmsSession)()
+            logger.info(
+                "Custom ssl certificates uploaded for use in VMS session."
+                if config.vms_ssl_cert.exists() else
+                "VMS session started without ssl certificates."
+            )
+            session.refresh_auth_token()
+            _vms_session = session
+        return _vms_session
@@ -131,7 +131,7 @@ class EmptyVolumeBuilder(BaseBuilder):
         )
 
     def _ensure_quota(self, requested_capacity, volume_name, view_path, tenant_id):
-        if quota := self.controller.vms_session.get_quota(self.name):
+        if quota := self.controller.vms_session.get_quota(self.name, path=view_path):
             # Check if volume with provided name but another capacity already exists.
             if quota.hard_limit != requested_capacity:
                 raise VolumeAlreadyExists(
@@ -208,7 +208,7 @@ class TestVolumeBuilder(BaseBuilder):
         """Main build entrypoint for tests"""
         if content_source := self.volume_content_source:
             if content_source.snapshot.snapshot_id:
-                if not self.configuration.fake_snapshot_store[content_source.snapshot.snapshot_id].exists():
+                if not self.controller._get_fake_snapshot(content_source.snapshot.snapshot_id):
                     raise SourceNotFound(f"Source snapshot does not exist: {content_source.snapshot.snapshot_id}")
 
         requested_capacity = self.get_requested_capacity()